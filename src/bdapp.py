@@ -1,9 +1,13 @@
+import pathlib
+import threading
 from tkinter import ttk
 from typing import Optional
 
 import mysql.connector
 
 from pygubuapp import PygubuApp
+from prefetcher import TablePrefetcher
+from snapshotstore import SnapshotStore
 from sqlproxy import MySQLTableProxy, TableRow
 import mysql.connector as sqlcon
 import tkinter
@@ -15,12 +19,33 @@ class BDApp(PygubuApp):
     ROW_NEWROW = -1
     VALUE_AUTOASSIGN = '<Primary Key>'
 
+    # Human-readable columns shown next to foreign key ids, keyed by referenced table
+    DISPLAY_COLUMNS = {
+        'employee': 'last_name',
+        'product_type': 'name',
+        'payment_method': 'name',
+    }
+
+    # Children of a hierarchy node are loaded this many at a time
+    HIERARCHY_PAGE_SIZE = 200
+
+    # Table snapshots are kept here between sessions, set to None to always load tables from the server
+    SNAPSHOT_DIRECTORY = pathlib.Path.home() / '.bdhomework' / 'snapshots'
+
+    # Tables are prefetched in the background while idle, up to this many rows in total
+    PREFETCH_ROW_BUDGET = 100000
+    PREFETCH_HISTORY_FILE = pathlib.Path.home() / '.bdhomework' / 'open_history.json'
+
     def __init__(self):
         super().__init__()
         self.dbconnection = None
         self.cursor = None
         self.row_editing = None
         self.table_proxy: Optional[MySQLTableProxy] = None
+        self.snapshot_store: Optional[SnapshotStore] = None
+        self.prefetcher: Optional[TablePrefetcher] = None
+        self.hierarchy_window: Optional[tkinter.Toplevel] = None
+        self.connection_args: Optional[dict] = None
         self.transaction_active = False
         self.row_widgets = []
 
@@ -42,21 +67,36 @@ class BDApp(PygubuApp):
         port = self.get_widget('port_entry').get()
 
         try:
-            self.dbconnection = sqlcon.connect(
-                host=host,
-                port=int(port),
-                user=user,
-                password=password,
-                autocommit=True,  # Will use START TRANSACTION when necessary
-                get_warnings=True,
-                raise_on_warnings=False,
-                connection_timeout=2,
-                buffered=True,
-            )
+            connection_args = {
+                'host': host,
+                'port': int(port),
+                'user': user,
+                'password': password,
+                'autocommit': True,  # Will use START TRANSACTION when necessary
+                'get_warnings': True,
+                'raise_on_warnings': False,
+                'connection_timeout': 2,
+                'buffered': True,
+            }
+
+            self.dbconnection = sqlcon.connect(**connection_args)
+            self.connection_args = connection_args
 
             self.cursor = self.dbconnection.cursor(buffered=True)
             self.cursor.execute('USE BDHOMEWORK;')
 
+            if BDApp.SNAPSHOT_DIRECTORY is not None:
+                self.snapshot_store = SnapshotStore(BDApp.SNAPSHOT_DIRECTORY, '{}:{}'.format(host, port))
+
+            self.prefetcher = TablePrefetcher(
+                lambda: sqlcon.connect(**connection_args),
+                'bdhomework',
+                BDApp.DISPLAY_COLUMNS,
+                self.snapshot_store,
+                BDApp.PREFETCH_ROW_BUDGET,
+                BDApp.PREFETCH_HISTORY_FILE
+            )
+
             self.swap_frame('table_list_frame')
 
         except Exception as e:
@@ -74,9 +114,60 @@ class BDApp(PygubuApp):
 
         table_name = listbox.get(selected[0])[0]
 
-        self.table_proxy = MySQLTableProxy(self.cursor, 'bdhomework', table_name)
+        # Foreground work always wins over prefetching
+        self.prefetcher.cancel(self.cursor)
+        self.prefetcher.record_open(table_name)
+
+        self.table_proxy = MySQLTableProxy(
+            self.cursor, 'bdhomework', table_name, BDApp.DISPLAY_COLUMNS, self.get_snapshot_store(),
+            self.prefetcher.take(table_name, self.cursor)
+        )
         self.swap_frame('table_view_frame')
 
+    def on_browsehierarchy(self):
+        listbox = self.get_widget('table_list')
+        selected = listbox.curselection()
+
+        if len(selected) != 1:
+            return
+
+        table_name = listbox.get(selected[0])[0]
+
+        # Foreground work always wins over prefetching
+        self.prefetcher.cancel(self.cursor)
+
+        # Only the schema is loaded, rows are fetched as nodes get expanded
+        proxy = MySQLTableProxy(self.cursor, 'bdhomework', table_name, load_tuples=False)
+
+        if proxy.get_hierarchy_attr() is None:
+            print('Table {} doesn\'t reference itself, can\'t browse it as a hierarchy'.format(table_name))
+            return
+
+        self.open_hierarchy_window(proxy)
+
+    def on_hierarchyopen(self, tree: ttk.Treeview, proxy: MySQLTableProxy):
+        node = tree.focus()
+        children = tree.get_children(node)
+
+        # Nodes with children hold a single placeholder until they're expanded for the first time
+        if len(children) != 1 or 'placeholder' not in tree.item(children[0], 'tags'):
+            return
+
+        tree.delete(children[0])
+        self.add_hierarchy_nodes(tree, proxy, node)
+
+        self.update_subtree_count(tree, proxy, node)
+
+    def on_hierarchyselect(self, tree: ttk.Treeview, proxy: MySQLTableProxy):
+        for item in tree.selection():
+            tags = tree.item(item, 'tags')
+
+            # Selecting a 'more' node loads the next page of its siblings in its place
+            if len(tags) == 2 and tags[0] == 'more':
+                node = tree.parent(item)
+                tree.delete(item)
+                self.add_hierarchy_nodes(tree, proxy, node, str(tags[1]))
+
     def on_cancelchanges(self):
         print('Rolled back changes.')
         self.try_rollback()
@@ -90,9 +181,17 @@ class BDApp(PygubuApp):
         pass
 
     def on_logoff(self):
+        self.prefetcher.cancel(self.cursor)
+        self.prefetcher = None
+
+        if self.hierarchy_window is not None:
+            self.hierarchy_window.destroy()
+            self.hierarchy_window = None
+
         self.dbconnection.close()
         self.dbconnection = None
         self.cursor = None
+        self.snapshot_store = None
 
         self.swap_frame('login_panel')
         pass
@@ -126,6 +225,8 @@ class BDApp(PygubuApp):
         else:
             retval = self.table_proxy.edit_row(self.row_editing, row)
 
+        self.prefetcher.discard()
+
         if retval == MySQLTableProxy.RESULT_OK:
             retval = 'Success!'
 
@@ -136,6 +237,7 @@ class BDApp(PygubuApp):
 
     def on_deleterow(self, row):
         self.table_proxy.delete_row(row)
+        self.prefetcher.discard()
         self.swap_frame('table_view_frame')
 
     def on_newrow(self):
@@ -151,6 +253,95 @@ class BDApp(PygubuApp):
     def get_widget(self, name):
         return self.builder.get_object(name)
 
+    def open_hierarchy_window(self, proxy: MySQLTableProxy):
+        if self.hierarchy_window is not None:
+            self.hierarchy_window.destroy()
+
+        hierarchy_attr = proxy.get_hierarchy_attr()
+        names = [row[0] for row in proxy.get_attributes()]
+
+        self.hierarchy_window = tkinter.Toplevel(self.mainwindow)
+        self.hierarchy_window.title('Hierarchy of ' + proxy.table)
+
+        tree = ttk.Treeview(self.hierarchy_window, columns=names)
+        tree.heading('#0', text=hierarchy_attr.fk_attribute)
+
+        for name in names:
+            tree.heading(name, text=name)
+
+        scrollbar = ttk.Scrollbar(self.hierarchy_window, orient='vertical', command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+
+        scrollbar.pack(side='right', fill='y', pady=5)
+        tree.pack(side='left', fill='both', expand=True, padx=5, pady=5)
+        tree.bind('<<TreeviewOpen>>', lambda event: self.on_hierarchyopen(tree, proxy))
+        tree.bind('<<TreeviewSelect>>', lambda event: self.on_hierarchyselect(tree, proxy))
+
+        self.add_hierarchy_nodes(tree, proxy, '')
+
+    def add_hierarchy_nodes(self, tree: ttk.Treeview, proxy: MySQLTableProxy, node, after_key=None):
+        # Node ids are the referenced key values, the top level node '' stands for rows without a parent
+        hierarchy_attr = proxy.get_hierarchy_attr()
+        key_index = [row[0] for row in proxy.get_attributes()].index(hierarchy_attr.fk_attribute)
+
+        parent_value = node if node != '' else None
+        page_size = BDApp.HIERARCHY_PAGE_SIZE
+
+        after = (1, after_key) if after_key is not None else None
+        results = proxy.get_subtree(parent_value, limit=page_size, after=after)
+
+        for depth, child_count, values in results:
+            key = values[key_index]
+            values = [MySQLTableProxy.VALUE_NULL if value is None else value for value in values]
+
+            if tree.exists(key):
+                continue  # Already shown, e.g. moved under another parent since it was loaded
+
+            tree.insert(node, 'end', iid=key, text=key, values=values)
+
+            if child_count > 0:
+                tree.insert(key, 'end', text='...', tags=('placeholder',))
+
+        if len(results) == page_size:
+            tree.insert(node, 'end', text='more...', tags=('more', results[-1][2][key_index]))
+
+    def update_subtree_count(self, tree: ttk.Treeview, proxy: MySQLTableProxy, node):
+        # Counting a large subtree can take a while, so it runs on its own connection in the background
+        # Tk isn't thread-safe, the result is picked up by polling from the Tk thread instead
+        result = []
+        connection_args = self.connection_args
+
+        def count():
+            try:
+                connection = sqlcon.connect(**connection_args)
+            except Exception as e:
+                print('Failed to count subtree: ' + str(e))
+                return
+
+            try:
+                cursor = connection.cursor(buffered=True)
+                cursor.execute('USE {};'.format(proxy.database))
+                result.append(proxy.get_subtree_count(node, cursor))
+            except Exception as e:
+                print('Failed to count subtree: ' + str(e))
+            finally:
+                connection.close()
+
+        worker = threading.Thread(target=count, daemon=True)
+        worker.start()
+
+        def poll():
+            if not tree.winfo_exists():
+                return  # Window was closed in the meantime
+
+            if worker.is_alive():
+                tree.after(100, poll)
+            elif len(result) != 0 and tree.exists(node):
+                count, truncated = result[0]
+                tree.item(node, text='{} ({}{} below)'.format(node, count, '+' if truncated else ''))
+
+        tree.after(100, poll)
+
     # Frame Initializers #
 
     def init_login_frame(self):
@@ -166,6 +357,9 @@ class BDApp(PygubuApp):
 
         self.table_proxy = None
 
+        # Operator is back at the table list, use the idle time to warm caches
+        self.mainwindow.after_idle(lambda: self.try_prefetch([row[0] for row in results]))
+
     def init_table_view(self):
         self.row_editing = None
         self.try_transaction()
@@ -195,6 +389,11 @@ class BDApp(PygubuApp):
 
                 if tuple_data is None:
                     tuple_data = MySQLTableProxy.VALUE_NULL
+                else:
+                    label = self.table_proxy.get_fk_label(x, tuple_data)
+
+                    if label is not None:
+                        tuple_data = '{} ({})'.format(tuple_data, label)
 
                 tkinter.Label(runtime_table, text=str(tuple_data)).grid(column=x, row=(y + 2), padx=5, pady=5)
 
@@ -306,6 +505,19 @@ class BDApp(PygubuApp):
 
         target.pack()
 
+    def try_prefetch(self, tables):
+        if self.prefetcher is None:
+            return  # Logged off before becoming idle
+
+        self.prefetcher.start(tables)
+
+    def get_snapshot_store(self):
+        # Rows seen inside a transaction may include uncommitted changes, keep them out of snapshots
+        if self.transaction_active:
+            return None
+
+        return self.snapshot_store
+
     def try_transaction(self):
         if self.transaction_active:
             return
@@ -0,0 +1,182 @@
+import json
+import pathlib
+import threading
+from collections import Counter
+from typing import Optional
+
+import mysql.connector
+
+from snapshotstore import SnapshotStore
+from sqlproxy import LoadCancelled, SQLTableCache, decode_bytes
+
+
+# Warms table caches on a separate connection while the operator is idle
+# cancel() stops the run and kills the query in flight, the next start() resumes it
+# Loads check the cancel event before each expensive query, so a KILL that lands between statements isn't lost
+class TablePrefetcher:
+    def __init__(self, connect, database, display_columns=None, snapshot_store: SnapshotStore = None,
+                 row_budget=100000, history_path=None):
+        self.connect = connect  # Callable that opens a new connection, cursors can't be shared between threads
+        self.database = database
+        self.display_columns = display_columns
+        self.snapshot_store = snapshot_store
+        self.row_budget = row_budget
+        self.history_path = pathlib.Path(history_path) if history_path is not None else None
+        self.history = self.__load_history()
+
+        self.__caches = {}
+        self.__loading = set()  # Connection ids of prefetch runs that are currently loading a table
+        self.__generation = 0  # Bumped by discard(), so loads that were in flight get dropped
+        self.__lock = threading.Lock()
+        self.__cancel = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+
+    def start(self, tables):
+        if self.__thread is not None and self.__thread.is_alive() and not self.__cancel.is_set():
+            return  # Already running
+
+        # Each run gets its own event, a cancelled run may still be finishing its last table
+        self.__cancel = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, args=(list(tables), self.__cancel), daemon=True)
+        self.__thread.start()
+
+    def cancel(self, cursor=None):
+        self.__cancel.set()
+
+        if cursor is None:
+            return
+
+        with self.__lock:
+            loading = list(self.__loading)
+
+        # Stop loads that are in flight right away, so they don't compete with the foreground
+        for connection_id in loading:
+            try:
+                cursor.execute('KILL QUERY {};'.format(int(connection_id)))
+            except mysql.connector.Error as e:
+                print('Failed to stop prefetch query: ' + str(e))
+
+    def take(self, table, cursor) -> Optional[SQLTableCache]:
+        # Caches are handed out once, after that the proxy owns and invalidates them
+        with self.__lock:
+            cache = self.__caches.pop(table, None)
+
+        if cache is None:
+            return None
+
+        # Other sessions may have changed the table since it was prefetched, row count plus max PK catches most changes
+        if cache.get_fingerprint(cursor) != cache.fingerprint:
+            print('Prefetched table {} changed, reloading'.format(table))
+            return None
+
+        return cache
+
+    def discard(self):
+        # Prefetched data doesn't see this session's writes, so it has to be dropped after any change
+        with self.__lock:
+            self.__caches.clear()
+            self.__generation += 1
+
+    def record_open(self, table):
+        self.history[table] += 1
+        self.__save_history()
+
+    def get_cached_rows(self):
+        with self.__lock:
+            return sum([len(cache.tuples) for cache in self.__caches.values()])
+
+    def __load_history(self):
+        if self.history_path is None:
+            return Counter()
+
+        try:
+            with open(self.history_path, 'r') as file:
+                return Counter(json.load(file))
+        except (OSError, ValueError):
+            return Counter()
+
+    def __save_history(self):
+        if self.history_path is None:
+            return
+
+        try:
+            self.history_path.parent.mkdir(parents=True, exist_ok=True)
+
+            with open(self.history_path, 'w') as file:
+                json.dump(dict(self.history), file)
+        except OSError as e:
+            print('Failed to save open history: ' + str(e))
+
+    def __get_priorities(self, cursor, tables):
+        # Row estimates are cheap to get from table statistics
+        cursor.execute(
+            'SELECT TABLE_NAME, TABLE_ROWS FROM INFORMATION_SCHEMA.TABLES '
+            'WHERE TABLE_SCHEMA = %s;', (self.database,)
+        )
+        row_estimates = {decode_bytes(row[0]): int(row[1] or 0) for row in cursor.fetchall()}
+
+        # Tables referenced by many others are likely to be needed for FK values
+        cursor.execute(
+            'SELECT REFERENCED_TABLE_NAME, COUNT(DISTINCT TABLE_NAME) FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE '
+            'WHERE TABLE_SCHEMA = %s AND REFERENCED_TABLE_NAME IS NOT NULL '
+            'GROUP BY REFERENCED_TABLE_NAME;', (self.database,)
+        )
+        referenced_by = {decode_bytes(row[0]): int(row[1]) for row in cursor.fetchall()}
+
+        # Most opened first, then most referenced, then smallest
+        tables = sorted(tables, key=lambda table: (
+            -self.history[table],
+            -referenced_by.get(table, 0),
+            row_estimates.get(table, 0)
+        ))
+
+        return [(table, row_estimates.get(table, 0)) for table in tables]
+
+    def __run(self, tables, cancel: threading.Event):
+        try:
+            connection = self.connect()
+        except Exception as e:
+            print('Prefetch failed to connect: ' + str(e))
+            return
+
+        try:
+            cursor = connection.cursor(buffered=True)
+            cursor.execute('USE {};'.format(self.database))
+
+            for table, row_estimate in self.__get_priorities(cursor, tables):
+                if cancel.is_set():
+                    break
+
+                with self.__lock:
+                    if table in self.__caches:
+                        continue
+
+                    generation = self.__generation
+
+                if row_estimate > self.row_budget - self.get_cached_rows():
+                    continue  # Doesn't fit, smaller tables further down might
+
+                with self.__lock:
+                    self.__loading.add(connection.connection_id)
+
+                try:
+                    cache = SQLTableCache(
+                        cursor, self.database, table, self.display_columns, self.snapshot_store, cancel_event=cancel
+                    )
+                finally:
+                    with self.__lock:
+                        self.__loading.discard(connection.connection_id)
+
+                # Row estimates can be stale or missing, so the budget is checked again with the real size
+                if len(cache.tuples) > self.row_budget - self.get_cached_rows():
+                    continue
+
+                with self.__lock:
+                    if generation == self.__generation:
+                        self.__caches[table] = cache
+        except LoadCancelled:
+            pass  # Foreground took over
+        except Exception as e:
+            print('Prefetch stopped: ' + str(e))
+        finally:
+            connection.close()
@@ -24,6 +24,9 @@ class PygubuApp:
     def on_tableopen(self):
         pass
 
+    def on_browsehierarchy(self):
+        pass
+
     def on_logoff(self):
         pass
 
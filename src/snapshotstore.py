@@ -0,0 +1,72 @@
+import os
+import pathlib
+import pickle
+import threading
+from typing import Optional
+from urllib.parse import quote
+
+
+class TableSnapshot:
+    def __init__(self):
+        self.attributes: list = []
+        self.tuples: list = []
+        self.fk_labels: dict = {}
+        self.row_count = 0
+        self.max_pk: Optional[int] = None
+        self.row_hash = 0
+
+
+# Keeps table snapshots (schema plus rows) on disk between sessions
+# Every snapshot is a separate pickle file named after host/database/table
+class SnapshotStore:
+    FORMAT_VERSION = 3
+
+    def __init__(self, directory, host):
+        self.directory = pathlib.Path(directory)
+        self.host = host
+        self.__lock = threading.Lock()
+
+    def get_path(self, database, table):
+        key = '{}/{}/{}'.format(self.host, database, table).lower()
+        return self.directory / (quote(key, safe='') + '.snapshot')
+
+    def load(self, database, table) -> Optional[TableSnapshot]:
+        path = self.get_path(database, table)
+
+        try:
+            with self.__lock, open(path, 'rb') as file:
+                version, snapshot = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print('Discarding unreadable snapshot: ' + str(e))
+            self.discard(database, table)
+            return None
+
+        if version != SnapshotStore.FORMAT_VERSION or not isinstance(snapshot, TableSnapshot):
+            return None
+
+        return snapshot
+
+    def save(self, database, table, snapshot: TableSnapshot):
+        path = self.get_path(database, table)
+        temp_path = path.with_suffix('.tmp')
+
+        try:
+            with self.__lock:
+                self.directory.mkdir(parents=True, exist_ok=True)
+
+                # Write to a temporary file first so a crash never leaves a half written snapshot
+                with open(temp_path, 'wb') as file:
+                    pickle.dump((SnapshotStore.FORMAT_VERSION, snapshot), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+                os.replace(temp_path, path)
+        except OSError as e:
+            print('Failed to save snapshot: ' + str(e))
+
+    def discard(self, database, table):
+        try:
+            with self.__lock:
+                os.remove(self.get_path(database, table))
+        except OSError:
+            pass
@@ -1,6 +1,8 @@
 from typing import Optional
 import mysql.connector
 
+from snapshotstore import SnapshotStore, TableSnapshot
+
 
 def save_database(cursor):
     cursor.execute('SELECT DATABASE();')
@@ -44,6 +46,25 @@ def decode_bytes(value):
     return value
 
 
+def convert_tuples(tuples):
+    return [tuple(get_value_for_python(value) for value in row) for row in tuples]
+
+
+# Builds a per-row CRC32 expression, so rows can be compared server-side without transferring them
+# Every value is prefixed with its length, so separators inside values can't make two rows encode the same
+# The ISNULL() suffix makes NULL distinguishable from missing values, since CONCAT_WS skips NULLs
+def get_row_crc_expression(columns):
+    return 'CRC32(CONCAT_WS("#", {0}, CONCAT({1})))'.format(
+        ', '.join(['LENGTH({0}), {0}'.format(column) for column in columns]),
+        ', '.join(['ISNULL({})'.format(column) for column in columns])
+    )
+
+
+# Raised when a load is cancelled through its cancel event, e.g. by the prefetcher
+class LoadCancelled(Exception):
+    pass
+
+
 class TableRow:
     def __init__(self):
         self.attributes = []
@@ -80,9 +101,24 @@ class TableAttribute:
 
 
 class SQLTableCache:
-    def __init__(self, cursor, database, table):
+    def __init__(self, cursor, database, table, display_columns=None, snapshot_store: SnapshotStore = None,
+                 load_tuples=True, cancel_event=None):
         self.table = table
         self.database = database
+        self.cancel_event = cancel_event  # threading.Event checked before the expensive queries
+
+        # Row count and max PK of the loaded rows, lets caches that were kept around be revalidated cheaply
+        self.fingerprint: Optional[tuple] = None
+
+        # Maps a referenced table to the column shown next to its ids, e.g. {'employee': 'last_name'}
+        self.display_columns: dict = display_columns if display_columns is not None else {}
+
+        # Labels for referenced ids, shared between all FKs pointing at the same table
+        # Layout is {fk_table: {fk_value: label}}
+        self.fk_labels: dict = {}
+
+        # Descendant counts for hierarchy browsing, layout is {parent_value: count}
+        self.subtree_counts: dict = {}
 
         last_database = save_database(cursor)
         use_database(cursor, database)
@@ -91,10 +127,6 @@ class SQLTableCache:
         cursor.execute('DESCRIBE {};'.format(table))
         self.attributes: list = cursor.fetchall()
 
-        # Get tuples
-        cursor.execute('SELECT * FROM {};'.format(table))
-        self.tuples: list = cursor.fetchall()
-
         # Get foreign key info
         cursor.execute('USE INFORMATION_SCHEMA;')
         cursor.execute(
@@ -111,13 +143,168 @@ class SQLTableCache:
         for i in range(0, len(self.attributes)):
             self.attributes[i] = tuple([decode_bytes(col) for col in self.attributes[i]])
 
-        # Convert tuple values to strings
-        for j in range(0, len(self.tuples)):
-            self.tuples[j] = tuple(get_value_for_python(value) for value in self.tuples[j])
+        for i in range(0, len(self.fk_info)):
+            self.fk_info[i] = tuple([decode_bytes(col) for col in self.fk_info[i]])
+
+        # Get tuples, along with FK labels if any were requested
+        self.display_fks: list = [row for row in self.fk_info if row[1] in self.display_columns]
+
+        if not load_tuples:
+            self.tuples: list = []  # Schema only, rows are fetched on demand (e.g. hierarchy browsing)
+        elif snapshot_store is not None:
+            self.tuples: list = self.__fetch_with_snapshot(cursor, snapshot_store)
+        else:
+            self.check_cancelled()
+            self.tuples: list = self.__fetch_rows(cursor)[0]
+
+        pk_index = self.get_int_pk_index()
+        max_pk = max([int(row[pk_index]) for row in self.tuples]) if pk_index is not None and self.tuples else None
+        self.fingerprint = (len(self.tuples), max_pk)
 
         restore_database(cursor, last_database)
         return
 
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise LoadCancelled('Loading {} was cancelled'.format(self.table))
+
+    def get_fingerprint(self, cursor):
+        # Row count and max PK, cheap enough to check on the foreground, unlike the full row hash
+        pk_index = self.get_int_pk_index()
+        max_pk = 'MAX({})'.format(self.attributes[pk_index][0]) if pk_index is not None else 'NULL'
+
+        last_database = save_database(cursor)
+        use_database(cursor, self.database)
+
+        cursor.execute('SELECT COUNT(*), {0} FROM {1};'.format(max_pk, self.table))
+        result = cursor.fetchall()[0]
+
+        restore_database(cursor, last_database)
+        return tuple(int(value) if value is not None else None for value in result)
+
+    def __get_select_parts(self):
+        # Returns the table's columns, the label columns and the FROM clause joining in the referenced tables
+        # Columns are qualified, since a self-referencing table is joined with itself
+        columns = ['t.' + row[0] for row in self.attributes]
+        labels = []
+        source = '{} t'.format(self.table)
+
+        for i in range(0, len(self.display_fks)):
+            column, fk_table, fk_attr = self.display_fks[i]
+            labels.append('j{0}.{1}'.format(i, self.display_columns[fk_table]))
+            source += ' LEFT JOIN {1} j{0} ON t.{2} = j{0}.{3}'.format(i, fk_table, column, fk_attr)
+
+        return columns, labels, source
+
+    def __fetch_rows(self, cursor, condition='', params=(), with_hash=False):
+        # Fetches rows and all requested labels in a single LEFT JOIN query
+        # Label columns are appended after the table's own columns, then split off
+        # Returns the rows and, if with_hash is set, the BIT_XOR of their row hashes computed in the same query
+        columns, labels, source = self.__get_select_parts()
+        attr_count = len(columns)
+        selected = columns + labels
+
+        if with_hash:
+            selected.append(get_row_crc_expression(columns + labels))
+
+        cursor.execute('SELECT {0} FROM {1}{2};'.format(', '.join(selected), source, condition), params)
+        results = cursor.fetchall()
+        row_hash = 0
+
+        column_index = [[row[0] for row in self.attributes].index(fk[0]) for fk in self.display_fks]
+
+        tuples = []
+        for row in results:
+            for i in range(0, len(self.display_fks)):
+                value = row[column_index[i]]
+
+                if value is None:
+                    continue
+
+                table_labels = self.fk_labels.setdefault(self.display_fks[i][1], {})
+                table_labels[get_value_for_python(value)] = get_value_for_python(decode_bytes(row[attr_count + i]))
+
+            tuples.append(row[:attr_count])
+
+            if with_hash:
+                row_hash ^= int(row[-1])
+
+        return convert_tuples(tuples), row_hash
+
+    def __fetch_fingerprint(self, cursor, last_max_pk):
+        # Row count, max PK and a hash of all rows, plus the same for rows up to the last known max PK
+        # Labels are part of the hash, so renaming a referenced row invalidates the snapshot as well
+        # The table is scanned server-side only, nothing but a single row is transferred
+        columns, labels, source = self.__get_select_parts()
+        row_crc = get_row_crc_expression(columns + labels)
+        pk_index = self.get_int_pk_index()
+
+        if pk_index is None:
+            cursor.execute('SELECT COUNT(*), NULL, BIT_XOR({0}), 0, 0 FROM {1};'.format(row_crc, source))
+        else:
+            cursor.execute(
+                'SELECT COUNT(*), MAX({0}), BIT_XOR({1}), '
+                'SUM({0} <= %s), BIT_XOR(IF({0} <= %s, {1}, 0)) '
+                'FROM {2};'.format(columns[pk_index], row_crc, source),
+                (last_max_pk, last_max_pk)
+            )
+
+        result = cursor.fetchall()[0]
+        return tuple(int(value) if value is not None else None for value in result)
+
+    def __fetch_with_snapshot(self, cursor, snapshot_store: SnapshotStore):
+        snapshot = snapshot_store.load(self.database, self.table)
+
+        if snapshot is not None and snapshot.attributes != self.attributes:
+            snapshot = None  # Schema changed, snapshot is useless
+
+        last_max_pk = snapshot.max_pk if snapshot is not None else None
+
+        # The server fingerprint only decides between reusing, extending or replacing the snapshot
+        self.check_cancelled()
+        row_count, max_pk, row_hash, prefix_count, prefix_hash = self.__fetch_fingerprint(cursor, last_max_pk)
+
+        if snapshot is not None and (snapshot.row_count, snapshot.row_hash) == (row_count, row_hash):
+            self.fk_labels = snapshot.fk_labels
+            return snapshot.tuples
+
+        self.check_cancelled()
+
+        prefix_unchanged = (snapshot.row_count, snapshot.row_hash) == (prefix_count or 0, prefix_hash) if snapshot else False
+        pk_index = self.get_int_pk_index()
+
+        # The saved count, max PK and hash are derived from the rows actually fetched, never from the fingerprint
+        # Rows changed between the two queries then can't be saved under a fingerprint that doesn't describe them
+        if prefix_unchanged and last_max_pk is not None:
+            # Only rows past the last known max PK changed, fetch just those
+            self.fk_labels = {fk_table: dict(labels) for fk_table, labels in snapshot.fk_labels.items()}
+            new_tuples, new_hash = self.__fetch_rows(
+                cursor, ' WHERE t.{} > %s'.format(self.attributes[pk_index][0]), (last_max_pk,), True
+            )
+            tuples = snapshot.tuples + new_tuples
+            row_hash = snapshot.row_hash ^ new_hash
+        else:
+            tuples, row_hash = self.__fetch_rows(cursor, with_hash=True)
+
+        snapshot = TableSnapshot()
+        snapshot.attributes = self.attributes
+        snapshot.tuples = tuples
+        snapshot.fk_labels = self.fk_labels
+        snapshot.row_count = len(tuples)
+        snapshot.max_pk = max([int(row[pk_index]) for row in tuples]) if pk_index is not None and tuples else None
+        snapshot.row_hash = row_hash
+        snapshot_store.save(self.database, self.table, snapshot)
+
+        return tuples
+
+    def get_fk_label(self, attr, value) -> Optional[str]:
+        info = self.get_attr_info(attr)
+
+        if info is None or not info.is_foreign_key or value is None:
+            return None
+
+        return self.fk_labels.get(info.fk_table, {}).get(value)
+
     def get_attr_info(self, attr) -> Optional[TableAttribute]:
         attr_row = None
 
@@ -162,45 +349,69 @@ class SQLTableCache:
 
         return row
 
-    def get_next_pk(self):
-        pk_list = []
-        pk_type = []
-        pk_index = []
+    def get_hierarchy_attr(self) -> Optional[TableAttribute]:
+        # A table is hierarchical if one of its FKs references the table itself
+        for row in self.fk_info:
+            if row[1] == self.table:
+                return self.get_attr_info(row[0])
 
-        for i in range(0, len(self.attributes)):
-            if self.attributes[i][3] == 'PRI':
-                pk_list.append(self.attributes[i][0])
-                pk_type.append(self.attributes[i][1])
-                pk_index.append(i)
+        return None
 
-        if len(pk_list) != 1:
-            return None  # Can't auto-generate composite PKs
+    def get_int_pk_index(self) -> Optional[int]:
+        pk_index = [i for i in range(0, len(self.attributes)) if self.attributes[i][3] == 'PRI']
 
-        if pk_type[0] != 'int':
-            return None  # Can't auto-generate non-int PKs
+        if len(pk_index) != 1:
+            return None  # Composite PKs can't be used as a single ordered key
 
-        return max([int(row[pk_index[0]]) for row in self.tuples]) + 1
+        if self.attributes[pk_index[0]][1] != 'int':
+            return None  # Only int PKs are ordered reliably
+
+        return pk_index[0]
+
+    def get_next_pk(self):
+        pk_index = self.get_int_pk_index()
+
+        if pk_index is None:
+            return None  # Can't auto-generate composite or non-int PKs
+
+        return max([int(row[pk_index]) for row in self.tuples]) + 1
 
 
 class MySQLTableProxy:
     RESULT_OK = 'RESULT_OK'
     VALUE_NULL = 'NULL'
+    HIERARCHY_MAX_DEPTH = 100
 
-    def __init__(self, cursor, database, table):
+    def __init__(self, cursor, database, table, display_columns=None, snapshot_store: SnapshotStore = None,
+                 cache: SQLTableCache = None, load_tuples=True):
         self.cursor = cursor
         self.database = database
         self.table = table
-        self.__cache = SQLTableCache(cursor, database, self.table)
+        self.display_columns = display_columns
+        self.snapshot_store = snapshot_store
+        self.load_tuples = load_tuples
+        self.__cache = cache if cache is not None else self.load_cache()
+
+    def load_cache(self):
+        return SQLTableCache(
+            self.cursor, self.database, self.table, self.display_columns, self.snapshot_store, self.load_tuples
+        )
 
     def get_cache(self):
         if self.__cache is None:
-            self.__cache = SQLTableCache(self.cursor, self.database, self.table)
+            self.__cache = self.load_cache()
 
         return self.__cache
 
     def invalidate_cache(self):
         self.__cache = None
 
+    def invalidate_after_write(self):
+        # This session's writes may still be rolled back, so they must never end up in a snapshot
+        # A plain reload is also cheaper than a fingerprint scan for a table that's known to have changed
+        self.snapshot_store = None
+        self.invalidate_cache()
+
     def get_attributes(self):
         sqlcache = self.get_cache()
         return sqlcache.attributes
@@ -213,10 +424,112 @@ class MySQLTableProxy:
         sqlcache = self.get_cache()
         return sqlcache.get_attr_info(attr)
 
+    def get_fk_label(self, attr, value):
+        sqlcache = self.get_cache()
+        return sqlcache.get_fk_label(attr, value)
+
     def get_row(self, index):
         sqlcache = self.get_cache()
         return sqlcache.get_row(index)
 
+    def get_hierarchy_attr(self):
+        sqlcache = self.get_cache()
+        return sqlcache.get_hierarchy_attr()
+
+    def get_subtree(self, parent_value, max_depth=1, limit=None, after=None):
+        # Returns (depth, child_count, row values) for descendants of parent_value, up to max_depth levels down
+        # A parent_value of None returns the roots of the hierarchy and their descendants
+        # child_count is the number of direct children, so views know which nodes can be expanded
+        # Results are ordered by depth then key, pages continue after the (depth, key) of the last row seen
+        # Paging by key instead of offset means rows inserted meanwhile can't shift rows onto the next page again
+        hierarchy_attr = self.get_hierarchy_attr()
+
+        if hierarchy_attr is None:
+            return None
+
+        parent = hierarchy_attr.name
+        key = hierarchy_attr.fk_attribute
+        anchor = 't.{} IS NULL'.format(parent) if parent_value is None else 't.{} = %s'.format(parent)
+
+        statement = (
+            'WITH RECURSIVE subtree AS ('
+            'SELECT t.*, 1 AS hierarchy_depth FROM {0} t WHERE {1} '
+            'UNION ALL '
+            'SELECT t.*, s.hierarchy_depth + 1 FROM {0} t JOIN subtree s ON t.{2} = s.{3} '
+            'WHERE s.hierarchy_depth < %s'
+            ') '
+            'SELECT p.*, (SELECT COUNT(*) FROM {0} c WHERE c.{2} = p.{3}) '
+            'FROM (SELECT * FROM subtree{4} ORDER BY hierarchy_depth, {3}{5}) p '
+            'ORDER BY p.hierarchy_depth, p.{3};'.format(
+                self.table, anchor, parent, key,
+                ' WHERE (hierarchy_depth, {}) > (%s, %s)'.format(key) if after is not None else '',
+                ' LIMIT %s' if limit is not None else ''
+            )
+        )
+
+        # Child counts are only computed for the rows of the requested page
+        params = (max_depth,) if parent_value is None else (parent_value, max_depth)
+
+        if after is not None:
+            params += tuple(after)
+
+        if limit is not None:
+            params += (limit,)
+
+        last_database = save_database(self.cursor)
+        use_database(self.cursor, self.database)
+
+        self.cursor.execute(statement, params)
+        results = self.cursor.fetchall()
+
+        restore_database(self.cursor, last_database)
+
+        return [(int(row[-2]), int(row[-1]), [get_value_for_python(value) for value in row[:-2]]) for row in results]
+
+    def get_subtree_count(self, parent_value, cursor=None):
+        # Counts all descendants of parent_value, results are kept until the cache is invalidated
+        # Returns (count, truncated), truncated is set if the tree goes deeper than HIERARCHY_MAX_DEPTH
+        # Large subtrees take a while, a cursor of another connection can be passed to count in the background
+        cursor = cursor if cursor is not None else self.cursor
+        sqlcache = self.get_cache()
+        hierarchy_attr = sqlcache.get_hierarchy_attr()
+
+        if hierarchy_attr is None or parent_value is None:
+            return None
+
+        if parent_value in sqlcache.subtree_counts:
+            return sqlcache.subtree_counts[parent_value]
+
+        parent = hierarchy_attr.name
+        key = hierarchy_attr.fk_attribute
+
+        statement = (
+            'WITH RECURSIVE subtree AS ('
+            'SELECT t.{2}, 1 AS hierarchy_depth FROM {0} t WHERE t.{1} = %s '
+            'UNION ALL '
+            'SELECT t.{2}, s.hierarchy_depth + 1 FROM {0} t JOIN subtree s ON t.{1} = s.{2} '
+            'WHERE s.hierarchy_depth < %s'
+            ') '
+            'SELECT COUNT(*), '
+            'SUM(s.hierarchy_depth = %s AND EXISTS (SELECT 1 FROM {0} c WHERE c.{1} = s.{2})) '
+            'FROM subtree s;'.format(self.table, parent, key)
+        )
+
+        max_depth = MySQLTableProxy.HIERARCHY_MAX_DEPTH
+
+        last_database = save_database(cursor)
+        use_database(cursor, self.database)
+
+        cursor.execute(statement, (parent_value, max_depth, max_depth))
+        result = cursor.fetchall()[0]
+
+        restore_database(cursor, last_database)
+
+        count = (int(result[0]), int(result[1] or 0) > 0)
+
+        sqlcache.subtree_counts[parent_value] = count
+        return count
+
     def get_next_pk(self):
         sqlcache = self.get_cache()
         return sqlcache.get_next_pk()
@@ -266,7 +579,7 @@ class MySQLTableProxy:
 
         restore_database(self.cursor, last_database)
 
-        self.invalidate_cache()
+        self.invalidate_after_write()
         return result
 
     def add_row(self, row: TableRow):
@@ -319,7 +632,7 @@ class MySQLTableProxy:
 
         restore_database(self.cursor, last_database)
 
-        self.invalidate_cache()
+        self.invalidate_after_write()
         return result
 
     def edit_row(self, index, row: TableRow):
@@ -379,5 +692,5 @@ class MySQLTableProxy:
 
         restore_database(self.cursor, last_database)
 
-        self.invalidate_cache()
+        self.invalidate_after_write()
         return result
@@ -0,0 +1,357 @@
+import argparse
+import getpass
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import mysql.connector
+import mysql.connector as sqlcon
+
+from sqlproxy import MySQLTableProxy, convert_tuples, get_row_crc_expression, get_value_for_statement, \
+    save_database, use_database, restore_database
+
+
+class TableChanges:
+    def __init__(self):
+        self.inserts: list = []  # Rows only present in the source
+        self.updates: list = []  # Source versions of rows that differ
+        self.deletes: list = []  # PK values only present in the target
+
+    def is_empty(self):
+        return len(self.inserts) == 0 and len(self.updates) == 0 and len(self.deletes) == 0
+
+
+# Compares a table between two databases by hashing primary key ranges server-side
+# Only ranges whose hashes differ are split further, and only the smallest of those are transferred
+# Both proxies should be created with load_tuples=False, they're only used for schema info and for applying changes
+class TableDiff:
+    def __init__(self, source: MySQLTableProxy, target: MySQLTableProxy, source_connect, target_connect,
+                 chunk_size=10000, leaf_size=200, workers=4, batch_size=500):
+        self.source = source
+        self.target = target
+        self.source_connect = source_connect  # Callables that open new connections, one is needed per worker thread
+        self.target_connect = target_connect
+        self.chunk_size = chunk_size
+        self.leaf_size = leaf_size
+        self.workers = workers
+        self.batch_size = batch_size
+
+        source_attributes = [row[0] for row in source.get_attributes()]
+        target_attributes = [row[0] for row in target.get_attributes()]
+
+        if source_attributes != target_attributes:
+            raise ValueError('Tables {} and {} have different attributes'.format(source.table, target.table))
+
+        pk_index = source.get_cache().get_int_pk_index()
+
+        if pk_index is None:
+            raise ValueError('Table {} needs a single int primary key to be compared'.format(source.table))
+
+        self.attributes = source_attributes
+        self.pk_index = pk_index
+        self.pk = source_attributes[pk_index]
+        self.row_crc = get_row_crc_expression(source_attributes)
+
+        self.__local = threading.local()
+        self.__connections = []
+        self.__lock = threading.Lock()
+
+    def compare(self) -> TableChanges:
+        changes = TableChanges()
+
+        low, high, walked = self.__get_pk_bounds()
+
+        if low is None:
+            return changes  # Both tables are empty
+
+        chunks = self.__get_chunks(walked, low, high)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for chunk_changes in executor.map(lambda chunk: self.__compare_range(*chunk), chunks):
+                    changes.inserts.extend(chunk_changes.inserts)
+                    changes.updates.extend(chunk_changes.updates)
+                    changes.deletes.extend(chunk_changes.deletes)
+        finally:
+            self.__close_connections()
+
+        return changes
+
+    def apply(self, changes: TableChanges):
+        # Makes the target equal to the source, using one statement per batch of rows
+        # Everything runs in one transaction on a dedicated connection, so a failure leaves the target untouched
+        # FK checks stay on, so cascades run and rows referencing missing parents fail the whole sync
+        sqlcache = self.target.get_cache()
+        attr_info = [sqlcache.get_attr_info(i) for i in range(0, len(self.attributes))]
+        types = [info.type for info in attr_info]
+
+        # Nullable FKs into the table itself (e.g. employee.manager_id) are detached first and set again at the end
+        # That way rows can reference rows that are inserted later, or are about to be deleted, in any order
+        self_refs = [
+            i for i in range(0, len(attr_info))
+            if attr_info[i].is_foreign_key and attr_info[i].fk_table == self.target.table and attr_info[i].can_have_null
+        ]
+
+        columns = ', '.join(self.attributes)
+        placeholders = ', '.join(['%s'] * len(self.attributes))
+        assignments = ', '.join(['{0} = VALUES({0})'.format(name) for name in self.attributes])
+
+        insert_statement = 'INSERT INTO {0} ({1}) VALUES ({2});'.format(self.target.table, columns, placeholders)
+        upsert_statement = 'INSERT INTO {0} ({1}) VALUES ({2}) ON DUPLICATE KEY UPDATE {3};'.format(
+            self.target.table, columns, placeholders, assignments
+        )
+        delete_statement = 'DELETE FROM {0} WHERE {1} IN ({{}});'.format(self.target.table, self.pk)
+
+        try:
+            connection = self.target_connect()
+        except Exception as e:
+            print('Failed to connect')
+            return str(e)
+
+        cursor = connection.cursor(buffered=True)
+
+        result = MySQLTableProxy.RESULT_OK
+        try:
+            cursor.execute('USE {};'.format(self.target.database))
+            cursor.execute('START TRANSACTION;')
+
+            if len(self_refs) != 0:
+                # Rows that go away or change must not hold references that could block the deletes
+                detach_statement = 'UPDATE {0} SET {1} WHERE {2} IN ({{}});'.format(
+                    self.target.table, ', '.join(['{} = NULL'.format(self.attributes[i]) for i in self_refs]), self.pk
+                )
+                detached = changes.deletes + [row[self.pk_index] for row in changes.updates]
+                self.__execute_keys(cursor, detach_statement, detached)
+
+            self.__execute_keys(cursor, delete_statement, changes.deletes)
+
+            # executemany() sends each batch of INSERTs as a single multi-row statement
+            self.__execute_rows(cursor, upsert_statement, changes.updates, types, self_refs)
+            self.__execute_rows(cursor, insert_statement, changes.inserts, types, self_refs)
+
+            if len(self_refs) != 0:
+                # Every row exists now, restore the self references
+                self.__execute_rows(cursor, upsert_statement, changes.updates + changes.inserts, types, [])
+
+            cursor.execute('COMMIT;')
+        except mysql.connector.Error as e:
+            print('Failed to execute statement')
+            result = str(e)
+        except Exception as e:
+            print('Failed to execute statement')
+            result = 'Input error: ' + str(e)
+
+        if result != MySQLTableProxy.RESULT_OK:
+            try:
+                cursor.execute('ROLLBACK;')
+            except mysql.connector.Error:
+                pass  # Closing the connection rolls back as well
+
+        connection.close()
+
+        self.target.invalidate_cache()
+        return result
+
+    def __execute_keys(self, cursor, statement, keys):
+        # statement has a single {} where the placeholders for a batch of PK values go
+        for i in range(0, len(keys), self.batch_size):
+            batch = keys[i:i + self.batch_size]
+            cursor.execute(statement.format(', '.join(['%s'] * len(batch))), tuple(int(value) for value in batch))
+
+    def __execute_rows(self, cursor, statement, rows, types, nulled):
+        # Columns listed in nulled are sent as NULL instead of their value
+        for i in range(0, len(rows), self.batch_size):
+            batch = [
+                tuple(None if j in nulled else get_value_for_statement(row[j], types[j]) for j in range(0, len(row)))
+                for row in rows[i:i + self.batch_size]
+            ]
+            cursor.executemany(statement, batch)
+
+    def __get_cursors(self):
+        # Cursors can't be shared between threads, so every worker opens its own pair of connections
+        if not hasattr(self.__local, 'cursors'):
+            cursors = []
+
+            for connect, proxy in [(self.source_connect, self.source), (self.target_connect, self.target)]:
+                connection = connect()
+
+                with self.__lock:
+                    self.__connections.append(connection)
+
+                cursor = connection.cursor(buffered=True)
+                cursor.execute('USE {};'.format(proxy.database))
+                cursors.append(cursor)
+
+            self.__local.cursors = cursors
+
+        return self.__local.cursors
+
+    def __close_connections(self):
+        with self.__lock:
+            for connection in self.__connections:
+                connection.close()
+
+            self.__connections.clear()
+
+        self.__local = threading.local()
+
+    def __get_pk_bounds(self):
+        # Returns the key range covering both tables, and the proxy whose rows are used for chunking
+        bounds = []
+
+        for proxy in [self.source, self.target]:
+            last_database = save_database(proxy.cursor)
+            use_database(proxy.cursor, proxy.database)
+
+            proxy.cursor.execute('SELECT MIN({0}), MAX({0}) FROM {1};'.format(self.pk, proxy.table))
+            bounds.append(proxy.cursor.fetchall()[0])
+
+            restore_database(proxy.cursor, last_database)
+
+        lows = [int(row[0]) for row in bounds if row[0] is not None]
+        highs = [int(row[1]) for row in bounds if row[1] is not None]
+
+        if len(lows) == 0:
+            return None, None, None
+
+        walked = self.source if bounds[0][0] is not None else self.target
+        return min(lows), max(highs), walked
+
+    def __get_chunks(self, proxy: MySQLTableProxy, low, high):
+        # Chunk boundaries are every chunk_size-th key of one table, so sparse keys don't produce empty chunks
+        # Rows only the other table has still fall into some chunk, and get narrowed down by bisection
+        cursor = proxy.cursor
+        boundaries = []
+        last = low - 1
+
+        last_database = save_database(cursor)
+        use_database(cursor, proxy.database)
+
+        while True:
+            cursor.execute(
+                'SELECT {0} FROM {1} WHERE {0} > %s ORDER BY {0} LIMIT 1 OFFSET %s;'.format(self.pk, proxy.table),
+                (last, self.chunk_size - 1)
+            )
+            results = cursor.fetchall()
+
+            if len(results) == 0:
+                break
+
+            last = int(results[0][0])
+            boundaries.append(last)
+
+        restore_database(cursor, last_database)
+
+        chunks = []
+        start = low
+        for boundary in boundaries:
+            chunks.append((start, boundary))
+            start = boundary + 1
+
+        if start <= high:
+            chunks.append((start, high))
+
+        return chunks
+
+    def __get_range_hash(self, cursor, table, low, high):
+        cursor.execute(
+            'SELECT COUNT(*), BIT_XOR({0}) FROM {1} WHERE {2} BETWEEN %s AND %s;'.format(self.row_crc, table, self.pk),
+            (low, high)
+        )
+        count, row_hash = cursor.fetchall()[0]
+        return int(count), int(row_hash)
+
+    def __get_range_rows(self, cursor, table, low, high):
+        cursor.execute('SELECT * FROM {0} WHERE {1} BETWEEN %s AND %s;'.format(table, self.pk), (low, high))
+        return {row[self.pk_index]: row for row in convert_tuples(cursor.fetchall())}
+
+    def __compare_range(self, low, high) -> TableChanges:
+        changes = TableChanges()
+        source_cursor, target_cursor = self.__get_cursors()
+
+        source_count, source_hash = self.__get_range_hash(source_cursor, self.source.table, low, high)
+        target_count, target_hash = self.__get_range_hash(target_cursor, self.target.table, low, high)
+
+        if (source_count, source_hash) == (target_count, target_hash):
+            return changes
+
+        if max(source_count, target_count) > self.leaf_size and low < high:
+            # Still too many rows to transfer, narrow down which half differs
+            middle = (low + high) // 2
+
+            for half in [self.__compare_range(low, middle), self.__compare_range(middle + 1, high)]:
+                changes.inserts.extend(half.inserts)
+                changes.updates.extend(half.updates)
+                changes.deletes.extend(half.deletes)
+
+            return changes
+
+        source_rows = self.__get_range_rows(source_cursor, self.source.table, low, high)
+        target_rows = self.__get_range_rows(target_cursor, self.target.table, low, high)
+
+        for pk, row in source_rows.items():
+            if pk not in target_rows:
+                changes.inserts.append(row)
+            elif target_rows[pk] != row:
+                changes.updates.append(row)
+
+        for pk in target_rows:
+            if pk not in source_rows:
+                changes.deletes.append(pk)
+
+        return changes
+
+
+def get_connector(address, user, password, database):
+    host, port = address.split(':') if ':' in address else (address, 3306)
+
+    return lambda: sqlcon.connect(
+        host=host,
+        port=int(port),
+        user=user,
+        password=password,
+        database=database,
+        autocommit=True,
+        connection_timeout=2,
+        buffered=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares a table between two servers and optionally syncs the target')
+    parser.add_argument('table')
+    parser.add_argument('--source', required=True, help='Source server as host:port')
+    parser.add_argument('--target', required=True, help='Target server as host:port')
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--database', default='bdhomework')
+    parser.add_argument('--apply', action='store_true', help='Make the target equal to the source')
+    args = parser.parse_args()
+
+    password = getpass.getpass()
+    source_connect = get_connector(args.source, args.user, password, args.database)
+    target_connect = get_connector(args.target, args.user, password, args.database)
+
+    source_connection = source_connect()
+    target_connection = target_connect()
+
+    source = MySQLTableProxy(source_connection.cursor(buffered=True), args.database, args.table, load_tuples=False)
+    target = MySQLTableProxy(target_connection.cursor(buffered=True), args.database, args.table, load_tuples=False)
+
+    diff = TableDiff(source, target, source_connect, target_connect)
+    changes = diff.compare()
+
+    print('{} inserts, {} updates, {} deletes'.format(len(changes.inserts), len(changes.updates), len(changes.deletes)))
+
+    if args.apply and not changes.is_empty():
+        result = diff.apply(changes)
+
+        if result == MySQLTableProxy.RESULT_OK:
+            result = 'Success!'
+
+        print('Status: ' + result)
+
+    source_connection.close()
+    target_connection.close()
+
+
+if __name__ == '__main__':
+    main()